@@ -1,9 +1,13 @@
 import os
-import json
+import hashlib
+import random
 import re
-import requests
+import asyncio
+import aiohttp
+import orjson
 import subprocess
-import tempfile
+from collections import deque
+from datetime import datetime
 from io import BytesIO
 from PIL import Image
 from atproto import Client
@@ -19,132 +23,424 @@ BSKY_USERNAME = os.getenv("BSKY_USERNAME")
 BSKY_PASSWORD = os.getenv("BSKY_PASSWORD")
 
 STATE_FILE = "tumblr_state.json"
+BLOOM_FILE = "tumblr_state.bloom"
+SESSION_FILE = "bsky_session.txt"   # exported atproto session, reused across runs
+
+BLOOM_BITS = 1 << 18         # 32 KiB; ~1e-4 false positives at ~13k IDs
+BLOOM_HASHES = 13
 
 MAX_BSKY_BLOB = 976_000      # hard Bluesky limit
 TARGET_MAX = 950_000         # safety margin
+MAX_IMAGES = 4               # Bluesky image embed limit
+MAX_VIDEO_BYTES = 100_000_000   # Bluesky video upload limit
+
+SAVE_EVERY = 10              # checkpoint state every N posts
+MAX_POSTED_IDS = 500         # exact IDs kept in tumblr_state.json
+POST_CONCURRENCY = 4         # posts whose media is prepared at once
+
+USE_NVENC = os.getenv("USE_NVENC", "auto").lower()   # auto | 1 | 0
+
+
+# ---------------------------------------------------------
+#                PRECOMPILED PATTERNS
+# ---------------------------------------------------------
+
+# Lazy scan anchored on whitespace: stop at the first src attribute instead
+# of running to the end of the tag and backtracking. Case-insensitive, either
+# quote style, optional spaces around "="
+IMG_SRC_RE = re.compile(
+    r"""<img(?=\s)[^>]*?\ssrc\s*=\s*["']([^"']+)["']""", re.IGNORECASE
+)
+MP4_SRC_RE = re.compile(r'src="([^"]+\.mp4)"')
+# One scan for both forms: group 1 is the ID from a .../post/<id> link,
+# group 2 a bare 18-19 digit ID (current Tumblr length). Bare IDs only
+# count when a post has no link, so timestamps and the like aren't used.
+TUMBLR_ID_RE = re.compile(r"/post/(\d+)|\b(\d{18,19})\b")
+HTML_SEP = "\n<!--SEP-->\n"   # joins HTML fragments for a single regex pass
+
+
+# ---------------------------------------------------------
+#                UTIL: HTTP SESSION
+# ---------------------------------------------------------
+
+DOWNLOAD_CHUNK = 65536
+FETCH_TRIES = 4
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+USER_AGENT = "Tumblr-Bluesky-Crossposter (+https://github.com/cdmdc4/Tumblr-Bluesky-Crossposter)"
+
+
+def make_http_session():
+    # One pooled session per run so Tumblr API + CDN fetches share
+    # keep-alive connections. No overall cap (videos can be slow), but a
+    # stalled connect or read fails fast and goes through with_retries.
+    connector = aiohttp.TCPConnector(limit=16, limit_per_host=8)
+    timeout = aiohttp.ClientTimeout(total=None, connect=5, sock_read=30)
+    return aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        headers={"User-Agent": USER_AGENT},
+    )
+
+
+def _retry_after(e):
+    # Seconds from a Retry-After header on a 429/503, if the server sent one
+    headers = getattr(e, "headers", None) or {}
+    try:
+        return float(headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+async def with_retries(op, *args, tries=FETCH_TRIES):
+    """
+    Await op(*args), retrying connection errors and 429/5xx responses
+    with exponential backoff plus jitter, or the server's Retry-After
+    when given. Other HTTP errors are raised straight away.
+    """
+    for attempt in range(tries):
+        try:
+            return await op(*args)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if isinstance(e, aiohttp.ClientResponseError) and e.status not in RETRY_STATUSES:
+                raise
+            if attempt == tries - 1:
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = 2 ** attempt + random.random()
+            delay = min(delay, 30)
+            print(f"Request failed ({e}) → retrying in {delay:.1f}s…")
+            await asyncio.sleep(delay)
+
+
+async def _download_once(session, url, max_bytes):
+    async with session.get(url) as resp:
+        resp.raise_for_status()
+        if max_bytes and (resp.content_length or 0) > max_bytes:
+            return None
+        buf = bytearray(resp.content_length or 0)
+        pos = 0
+        async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK):
+            end = pos + len(chunk)
+            if max_bytes and end > max_bytes:
+                return None
+            buf[pos:end] = chunk
+            pos = end
+        del buf[pos:]
+    return bytes(buf)
+
+
+async def download_bytes(session, url, max_bytes=None):
+    """
+    Stream a download into a buffer pre-sized from Content-Length
+    instead of joining all chunks at the end. Returns None without
+    reading the body when it would exceed max_bytes.
+    """
+    return await with_retries(_download_once, session, url, max_bytes)
+
+
+# Tumblr CDN serves the same image at smaller sizes under these names
+TUMBLR_SIZE_VARIANTS = (("_1280.", "_640."), ("s1280x1920", "s640x960"))
+
+
+async def head_size(session, url):
+    """
+    Content-Length from a HEAD request, or None if unknown/failed.
+    """
+    try:
+        async with session.head(url, allow_redirects=True) as resp:
+            if resp.status != 200:
+                return None
+            return resp.content_length
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
+
+
+async def pick_image_url(session, url):
+    """
+    HEAD the image first; if it's over the Bluesky blob limit, swap to a
+    smaller Tumblr size variant when one exists. Falls back to the
+    original URL (compression handles the rest).
+    """
+    size = await head_size(session, url)
+    if not size or size <= MAX_BSKY_BLOB:
+        return url
+
+    for big, small in TUMBLR_SIZE_VARIANTS:
+        if big in url:
+            smaller = url.replace(big, small)
+            if await head_size(session, smaller):
+                print(f"→ Using smaller variant of {url} ({size} bytes at full size)")
+                return smaller
+
+    return url
 
 
 # ---------------------------------------------------------
 #                UTIL: BLUESKY CLIENT
 # ---------------------------------------------------------
 
-def get_bsky_client():
+_bsky_client = None
+
+
+def _load_session_string():
+    try:
+        with open(SESSION_FILE, "r") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def _save_session_string(event, session):
+    # atproto calls this on login, import and every token refresh, so the
+    # file always holds the newest tokens
+    try:
+        _write_atomic(SESSION_FILE, session.export().encode(), private=True)
+    except OSError as e:
+        print("Could not save Bluesky session:", e)
+
+
+def _new_bsky_client():
     client = Client()
-    client.login(BSKY_USERNAME, BSKY_PASSWORD)
+    client.on_session_change(_save_session_string)
     return client
 
 
+def get_bsky_client():
+    """
+    Log in lazily and at most once per process. Resumes the session saved
+    by the previous run when possible, falling back to a password login.
+    """
+    global _bsky_client
+    if _bsky_client is None:
+        client = None
+        session_string = _load_session_string()
+        if session_string:
+            try:
+                client = _new_bsky_client()
+                client.login(session_string=session_string)
+            except Exception as e:
+                print("Saved Bluesky session rejected, logging in again:", e)
+                client = None
+        if client is None:
+            client = _new_bsky_client()
+            client.login(BSKY_USERNAME, BSKY_PASSWORD)
+        _bsky_client = client
+    return _bsky_client
+
+
 # ---------------------------------------------------------
 #                STATE MANAGEMENT
 # ---------------------------------------------------------
 
+def _write_atomic(path, data, private=False):
+    # Write next to the target and rename over it, so a run killed
+    # mid-write can never leave a truncated state file behind. fsync
+    # before the rename so a crash can't expose an empty file either.
+    # private=True restricts the file to its owner (0600) before any
+    # data is written.
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        if private:
+            os.fchmod(f.fileno(), 0o600)
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
 def load_state():
     try:
-        with open(STATE_FILE, "r") as f:
-            data = json.load(f)
-            if isinstance(data, dict) and "posted_ids" in data:
-                return data
-            return {"posted_ids": []}
+        with open(STATE_FILE, "rb") as f:
+            data = orjson.loads(f.read())
     except FileNotFoundError:
-        return {"posted_ids": []}
+        data = None
+
+    if not (isinstance(data, dict) and "posted_ids" in data):
+        data = {"posted_ids": []}
+
+    # bounded deque: appends past the cap drop the oldest ID in O(1)
+    data["posted_ids"] = deque(data["posted_ids"], maxlen=MAX_POSTED_IDS)
+    return data
 
 
 def save_state(state):
-    state["posted_ids"] = state["posted_ids"][-500:]
-    with open(STATE_FILE, "w") as f:
-        json.dump(state, f, indent=2)
+    # serialize up front so the file gets a single buffered write
+    data = dict(state, posted_ids=list(state["posted_ids"]))
+    _write_atomic(STATE_FILE, orjson.dumps(data))
+
+
+# posted_ids only keeps the last 500 IDs; the Bloom filter remembers every
+# ID ever posted in a fixed 32 KiB, so old posts never get re-crossposted.
+
+def _bloom_positions(post_id):
+    digest = hashlib.blake2b(post_id.encode(), digest_size=16).digest()
+    h1 = int.from_bytes(digest[:8], "little")
+    h2 = int.from_bytes(digest[8:], "little") | 1
+    for i in range(BLOOM_HASHES):
+        yield (h1 + i * h2) % BLOOM_BITS
+
+
+def bloom_add(bloom, post_id):
+    for pos in _bloom_positions(post_id):
+        bloom[pos >> 3] |= 1 << (pos & 7)
+
+
+def bloom_contains(bloom, post_id):
+    return all(bloom[pos >> 3] & (1 << (pos & 7)) for pos in _bloom_positions(post_id))
+
+
+def load_bloom(seed_ids):
+    try:
+        with open(BLOOM_FILE, "rb") as f:
+            data = f.read()
+        if len(data) == BLOOM_BITS // 8:
+            return bytearray(data)
+    except FileNotFoundError:
+        pass
+
+    # Missing or resized filter: rebuild from the IDs we still have
+    bloom = bytearray(BLOOM_BITS // 8)
+    for pid in seed_ids:
+        bloom_add(bloom, pid)
+    return bloom
+
+
+def save_bloom(bloom):
+    _write_atomic(BLOOM_FILE, bloom)
 
 
 # ---------------------------------------------------------
 #                TUMBLR API
 # ---------------------------------------------------------
 
-def get_recent_tumblr_posts():
+async def _get_tumblr_json(session, url, headers):
+    async with session.get(url, headers=headers) as r:
+        if r.status == 304:
+            return r.status, None, None
+        if r.status in RETRY_STATUSES:
+            r.raise_for_status()
+        return r.status, r.headers.get("ETag"), orjson.loads(await r.read())
+
+
+async def get_recent_tumblr_posts(session, etag=None):
+    """
+    Returns (posts, etag). posts is None when Tumblr answers 304 Not
+    Modified for the ETag saved by the previous run.
+    """
     url = (
         f"https://api.tumblr.com/v2/blog/{TUMBLR_BLOG}/posts"
         f"?api_key={TUMBLR_API_KEY}&notes_info=false&reblog_info=false&limit=30"
     )
-    resp = requests.get(url).json()
-    try:
-        posts = resp["response"]["posts"]
-    except:
-        return []
+    headers = {"If-None-Match": etag} if etag else {}
+    status, new_etag, resp = await with_retries(_get_tumblr_json, session, url, headers)
+    if status == 304:
+        return None, etag
 
+    posts = (resp.get("response") or {}).get("posts") or []
+
+    # The API rarely repeats a post, so only copy the list once a
+    # duplicate actually turns up
     seen = set()
-    clean = []
-    for p in posts:
+    clean = None
+    for i, p in enumerate(posts):
         pid = str(p.get("id"))
-        if pid not in seen:
+        if pid in seen:
+            if clean is None:
+                clean = posts[:i]
+            continue
+        seen.add(pid)
+        if clean is not None:
             clean.append(p)
-            seen.add(pid)
 
-    return clean
+    return (posts if clean is None else clean), new_etag
 
 
 # ---------------------------------------------------------
 #                MEDIA EXTRACTION
 # ---------------------------------------------------------
 
-def extract_images(post):
-    urls = []
+MEDIA_KIND_BY_EXT = {".mp4": "video", ".gif": "gif"}
 
-    for block in post.get("content", []):
-        if block.get("type") == "image":
-            for media in block.get("media", []):
-                if "url" in media:
-                    urls.append(media["url"])
-
-    for item in post.get("trail", []):
-        html = item.get("content_raw") or ""
-        urls += re.findall(r'<img[^>]+src="([^"]+)"', html)
-
-    body = post.get("body", "")
-    urls += re.findall(r'<img[^>]+src="([^"]+)"', body)
 
-    if post.get("type") == "photo":
-        for p in post.get("photos", []):
-            try:
-                urls.append(p["original_size"]["url"])
-            except:
-                pass
+def url_kind(url):
+    """Classify a media URL as "video", "gif" or "image" by extension."""
+    path = url.lower().split("?", 1)[0]
+    return MEDIA_KIND_BY_EXT.get(path[path.rfind("."):], "image")
 
-    clean = []
-    for u in urls:
-        if u not in clean:
-            clean.append(u)
-
-    return clean[:4]
 
+def extract_media(post):
+    """
+    Walk the post once and return (video, gif, images).
 
-def extract_gif(post):
-    for url in extract_images(post):
-        if url.lower().endswith(".gif"):
-            return url
-    return None
+    Video priority matches the old extract_video: NPF video block,
+    legacy video_url, trail HTML, then player embeds. Images are
+    deduped and capped at MAX_IMAGES; gif is the first .gif among them.
+    """
+    found = {}   # insertion-ordered set of image URLs
+    video = None
 
+    def add(url):
+        # True once the cap is reached, so callers can stop scanning
+        found[url] = None
+        return len(found) >= MAX_IMAGES
 
-def extract_video(post):
     for block in post.get("content", []):
-        if block.get("type") == "video":
+        btype = block.get("type")
+        if btype == "image":
             for media in block.get("media", []):
-                u = media.get("url", "")
-                if u.endswith(".mp4"):
-                    return u
+                if "url" in media and len(found) < MAX_IMAGES:
+                    add(media["url"])
+        elif btype == "video" and video is None:
+            for media in block.get("media", []):
+                u = media.get("url")
+                if u and url_kind(u) == "video":
+                    video = u
+                    break
+
+    if video is None:
+        u = post.get("video_url")
+        if u and url_kind(u) == "video":
+            video = u
+
+    # One scan over all trail HTML plus the body instead of one per
+    # fragment; the separator closes any unterminated tag
+    trail_html = HTML_SEP.join(
+        item.get("content_raw") or "" for item in post.get("trail", [])
+    )
+    if len(found) < MAX_IMAGES:
+        html = trail_html + HTML_SEP + post.get("body", "")
+        for m in IMG_SRC_RE.finditer(html):
+            if add(m.group(1)):
+                break
+
+    if video is None:
+        m = MP4_SRC_RE.search(trail_html)
+        if m:
+            video = m.group(1)
 
-    if post.get("video_url", "").endswith(".mp4"):
-        return post["video_url"]
+    if post.get("type") == "photo" and len(found) < MAX_IMAGES:
+        for p in post.get("photos", []):
+            u = p.get("original_size", {}).get("url")
+            if u and add(u):
+                break
 
-    for t in post.get("trail", []):
-        m = re.search(r'src="([^"]+\.mp4)"', t.get("content_raw", ""))
-        if m:
-            return m.group(1)
+    if video is None:
+        for embed in post.get("player", []):
+            m = MP4_SRC_RE.search(embed.get("embed_code", ""))
+            if m:
+                video = m.group(1)
+                break
 
-    for embed in post.get("player", []):
-        m = re.search(r'src="([^"]+\.mp4)"', embed.get("embed_code", ""))
-        if m:
-            return m.group(1)
+    images = list(found)
 
-    return None
+    gif = None
+    for url in images:
+        if url_kind(url) == "gif":
+            gif = url
+            break
+
+    return video, gif, images
 
 
 # ---------------------------------------------------------
@@ -170,103 +466,191 @@ def make_post_text(tumblr_url, post):
 #         GIF → MP4 Conversion (FFmpeg)
 # ---------------------------------------------------------
 
-def convert_gif_to_mp4(gif_bytes):
-    gif_path = None
-    mp4_path = None
+X264_ARGS = ["-vcodec", "libx264", "-preset", "faster", "-crf", "28"]
+NVENC_ARGS = [
+    "-vcodec", "h264_nvenc",
+    "-preset", "p4",
+    "-rc", "vbr",
+    "-cq", "28",
+    "-b:v", "0",
+]
+# Caps the peak bitrate only (900 kbit/s ≈ 112 KB/s), so clips longer than
+# ~8 s can still exceed 900 KB; the len(mp4_data) check enforces the size
+RATE_CAP_ARGS = ["-maxrate", "900k", "-bufsize", "1800k"]
+
+_nvenc_available = None
+
+
+def nvenc_available():
+    # Ask ffmpeg once per process whether it was built with h264_nvenc
+    global _nvenc_available
+    if _nvenc_available is None:
+        if USE_NVENC in ("0", "false", "no"):
+            _nvenc_available = False
+        elif USE_NVENC in ("1", "true", "yes"):
+            _nvenc_available = True
+        else:
+            try:
+                out = subprocess.run(
+                    ["ffmpeg", "-hide_banner", "-encoders"],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                ).stdout
+                _nvenc_available = b"h264_nvenc" in out
+            except OSError:
+                _nvenc_available = False
+    return _nvenc_available
 
-    try:
-        with tempfile.NamedTemporaryFile(suffix=".gif", delete=False) as gif_file:
-            gif_file.write(gif_bytes)
-            gif_path = gif_file.name
 
-        mp4_path = gif_path.replace(".gif", ".mp4")
+def convert_gif_to_mp4(gif_bytes):
+    """
+    Pipe the GIF through ffmpeg on stdin/stdout; no temp files. The MP4 is
+    fragmented (empty_moov) because stdout isn't seekable. Encodes on
+    NVENC when available, falling back to libx264.
+    """
+    global _nvenc_available
+    encoders = [X264_ARGS]
+    if nvenc_available():
+        encoders.insert(0, NVENC_ARGS)
 
+    mp4_data = None
+    for encoder_args in encoders:
         cmd = [
             "ffmpeg",
             "-y",
-            "-i", gif_path,
-            "-movflags", "faststart",
+            "-f", "gif",
+            "-i", "pipe:0",
             "-vf", "scale=-1:720:force_original_aspect_ratio=decrease",
             "-pix_fmt", "yuv420p",
-            "-vcodec", "libx264",
-            "-preset", "veryfast",
+            *encoder_args,
+            *RATE_CAP_ARGS,
             "-an",
-            mp4_path,
+            "-f", "mp4",
+            "-movflags", "frag_keyframe+empty_moov",
+            "pipe:1",
         ]
 
-        subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        with open(mp4_path, "rb") as f:
-            mp4_data = f.read()
-
-        if len(mp4_data) > 900_000:
-            print("MP4 still too large after compression.")
-            return None
+        try:
+            proc = subprocess.run(
+                cmd,
+                input=gif_bytes,
+                check=True,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+        except (OSError, subprocess.CalledProcessError) as e:
+            # Listed encoders can still fail without a usable GPU; don't
+            # try NVENC again this run
+            print(f"FFmpeg conversion failed ({encoder_args[1]}):", e)
+            if encoder_args is NVENC_ARGS:
+                _nvenc_available = False
+            continue
 
-        return mp4_data
+        mp4_data = proc.stdout
+        break
 
-    except Exception as e:
-        print("FFmpeg conversion failed:", e)
+    if mp4_data is None:
         return None
 
-    finally:
-        # Always clean up temp files
-        try:
-            if gif_path and os.path.exists(gif_path):
-                os.remove(gif_path)
-        except:
-            pass
-
-        try:
-            if mp4_path and os.path.exists(mp4_path):
-                os.remove(mp4_path)
-        except:
-            pass
+    if len(mp4_data) > 900_000:
+        print("MP4 still too large after compression.")
+        return None
 
+    return mp4_data
 
 
 # ---------------------------------------------------------
 #    IMAGE COMPRESSION ENGINE (JPEG + DOWNSCALE)
 # ---------------------------------------------------------
 
-def compress_and_resize(image_bytes):
-    if len(image_bytes) <= MAX_BSKY_BLOB:
-        return image_bytes
+SCALE_FACTORS = (1.0, 0.8, 0.6, 0.4, 0.3)
+JPEG_Q_MIN = 40
+JPEG_Q_MAX = 95
+DRAFT_MAX = 2000             # Bluesky serves images at most 2000 px a side
+
+
+def _encode_jpeg(img, quality, **opts):
+    buf = BytesIO()
+    img.save(buf, format="JPEG", quality=quality, **opts)
+    return buf.getvalue()
 
-    print(f"Image too large ({len(image_bytes)/1024:.1f} KB) → compressing + resizing…")
 
+def _fit_jpeg_quality(img, limit):
+    """
+    Binary-search the highest JPEG quality that fits in `limit` bytes.
+    Returns (quality, data), or (None, None) if even the lowest is too big.
+    """
+    lo, hi = JPEG_Q_MIN, JPEG_Q_MAX
+    best_q, best = None, None
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        data = _encode_jpeg(img, mid)
+        if len(data) <= limit:
+            best_q, best = mid, data
+            lo = mid + 1
+        else:
+            hi = mid - 1
+    return best_q, best
+
+
+def decode_image(image_bytes):
+    """
+    Decode into an RGB PIL image that is safe to save as JPEG.
+    JPEGs are decoded straight at reduced size (libjpeg DCT scaling) when
+    they're far larger than Bluesky will ever show.
+    """
     try:
         img = Image.open(BytesIO(image_bytes))
+        img.draft("RGB", (DRAFT_MAX, DRAFT_MAX))
+        img.load()
     except Exception as e:
         print("❌ Cannot open image:", e)
         return None
 
-    if img.mode in ("RGBA", "LA"):
-        img = img.convert("RGB")
+    # Flatten transparency onto white; a plain convert("RGB") leaves
+    # black behind transparent pixels, which looks wrong and encodes larger
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        rgba = img.convert("RGBA")
+        img = Image.new("RGB", rgba.size, (255, 255, 255))
+        img.paste(rgba, mask=rgba.getchannel("A"))
+    elif img.mode == "P":
+        img = img.convert("RGB")   # JPEG can't store palettes
+    return img
 
-    width, height = img.size
 
-    scale_factors = [1.0, 0.9, 0.8, 0.7, 0.6, 0.5]
-    qualities = [95, 90, 85, 80, 75, 70]
+def compress_image(img, limit):
+    """
+    JPEG-encode a decoded image under `limit` bytes, downscaling only
+    when no quality fits at the current size.
+    """
+    width, height = img.size
 
-    for scale in scale_factors:
+    for scale in SCALE_FACTORS:
         w = max(1, int(width * scale))
         h = max(1, int(height * scale))
-        resized = img.resize((w, h), Image.LANCZOS)
+        resized = img if scale == 1.0 else img.resize((w, h), Image.LANCZOS)
 
-        for q in qualities:
-            buf = BytesIO()
-            try:
-                resized.save(buf, format="JPEG", quality=q)
-            except Exception:
-                continue
+        try:
+            q, data = _fit_jpeg_quality(resized, limit)
+        except Exception as e:
+            print(f" → {w}x{h}: encode failed:", e)
+            continue
 
-            data = buf.getvalue()
-            print(f" → {w}x{h} q{q}: {len(data)/1024:.1f} KB")
+        if data is None:
+            print(f" → {w}x{h}: too large even at q{JPEG_Q_MIN}")
+            continue
+
+        # Search without optimize (faster); spend it once on the winner
+        try:
+            tuned = _encode_jpeg(resized, q, optimize=True, progressive=True)
+            if len(tuned) <= len(data):
+                data = tuned
+        except Exception:
+            pass
 
-            if len(data) <= TARGET_MAX:
-                print(" ✓ Compression successful.")
-                return data
+        print(f" → {w}x{h} q{q}: {len(data)/1024:.1f} KB")
+        print(" ✓ Compression successful.")
+        return data
 
     print("❌ Could not compress image under limit.")
     return None
@@ -279,174 +663,250 @@ def compress_and_resize(image_bytes):
 def upload_with_compression(client, raw):
     """
     ALWAYS check size before upload.
-    If > MAX_BSKY_BLOB → compress.
-    If Bluesky still returns BlobTooLarge → compress again.
+    If > MAX_BSKY_BLOB → compress to TARGET_MAX, which leaves enough slack
+    under the hard limit that Bluesky never answers BlobTooLarge.
     """
-
-    # Pre-check
     if len(raw) > MAX_BSKY_BLOB:
         print(f"Raw image too large ({len(raw)/1024:.1f} KB) → compressing…")
-        raw = compress_and_resize(raw)
+        img = decode_image(raw)
+        if img is None:
+            return None
+        raw = compress_image(img, TARGET_MAX)
         if raw is None:
             return None
 
-    # Try uploading
-    resp = client.com.atproto.repo.upload_blob(raw)
-
-    # Bluesky returns Response(success=False…, not an exception)
-    if getattr(resp, "success", True) is False:
-        err = getattr(resp, "content", "")
-        if hasattr(err, "error") and err.error == "BlobTooLarge":
-            print("BlobTooLarge → compressing again…")
-            raw2 = compress_and_resize(raw)
-            if raw2 is None:
-                return None
-            return client.com.atproto.repo.upload_blob(raw2)
-
-    return resp
+    return client.com.atproto.repo.upload_blob(raw)
 
 
 # ---------------------------------------------------------
 #                BLUESKY POSTING HELPERS
 # ---------------------------------------------------------
 
-def post_to_bluesky_video(client, post_text, video_url, alt_text):
-    print("Downloading video…")
-    data = requests.get(video_url).content
+# atproto's Client is synchronous; these run it on the default thread pool
+# so blob uploads overlap with downloads still in flight.
 
-    print("Uploading blob…")
-    blob = client.com.atproto.repo.upload_blob(data)
+async def upload_blob_async(client, data):
+    return await asyncio.to_thread(client.com.atproto.repo.upload_blob, data)
 
-    video_embed = {
-        "$type": "app.bsky.embed.video",
-        "video": blob.blob,
-        "alt": alt_text
-    }
 
+async def upload_with_compression_async(client, raw):
+    return await asyncio.to_thread(upload_with_compression, client, raw)
+
+
+def create_post(client, did, post_text, embed, created_at):
     return client.app.bsky.feed.post.create(
-        repo=client.me.did,
+        repo=did,
         record={
             "$type": "app.bsky.feed.post",
             "text": post_text,
-            "embed": video_embed,
-            "createdAt": client.get_current_time_iso(),
-        }
+            "embed": embed,
+            "createdAt": created_at,
+        },
     )
 
 
-def post_to_bluesky_images(client, post_text, image_urls, alt_text):
-    uploaded = []
+async def create_post_async(client, did, post_text, embed, created_at):
+    return await asyncio.to_thread(create_post, client, did, post_text, embed, created_at)
+
 
-    for url in image_urls:
-        raw = requests.get(url).content
+# The prepare_* helpers download + upload the media and return the embed
+# (or None); creating the record is left to the caller so posts can be
+# prepared concurrently but still published in order.
 
-        blob = upload_with_compression(client, raw)
+async def prepare_video_embed(client, session, video_url, alt_text, post_id):
+    print(f"Downloading video… ({post_id})")
+    data = await download_bytes(session, video_url, MAX_VIDEO_BYTES)
+    if data is None:
+        print(f"❌ Video over Bluesky's size limit ({post_id}) — skipping.")
+        return None
+
+    print(f"Uploading blob… ({post_id})")
+    blob = await upload_blob_async(client, data)
+
+    return {
+        "$type": "app.bsky.embed.video",
+        "video": blob.blob,
+        "alt": alt_text
+    }
+
+
+# atproto's httpx client is thread-safe, so every image of a carousel can
+# upload at once
+UPLOAD_WORKERS = MAX_IMAGES
+
+
+async def _upload_images_async(client, session, image_urls, post_id):
+    """
+    Two-stage pipeline: step A downloads images concurrently and queues
+    the bytes, step B workers upload whatever is ready. Results keep the
+    input order.
+    """
+    sem = asyncio.Semaphore(4)
+    queue_ab = asyncio.Queue(maxsize=4)
+    results = [None] * len(image_urls)
+    errors = []
+
+    async def do_step_a(index, url):
+        # A dead image only drops that slot; failing the whole gather would
+        # orphan the blobs already uploaded and retry the carousel forever.
+        try:
+            async with sem:
+                url = await pick_image_url(session, url)
+                raw = await download_bytes(session, url)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            print(f"❌ Image download failed ({post_id}, {url}):", e)
+            raw = None
+        await queue_ab.put((index, raw))
+
+    async def do_step_b():
+        while True:
+            index, raw = await queue_ab.get()
+            try:
+                if raw is not None:
+                    results[index] = await upload_with_compression_async(client, raw)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                queue_ab.task_done()
+
+    workers = [asyncio.create_task(do_step_b()) for _ in range(UPLOAD_WORKERS)]
+    try:
+        await asyncio.gather(
+            *(do_step_a(i, u) for i, u in enumerate(image_urls))
+        )
+        await queue_ab.join()
+    finally:
+        for w in workers:
+            w.cancel()
+
+    if errors:
+        raise errors[0]
+
+    return results
+
+
+async def prepare_images_embed(client, session, image_urls, alt_text, post_id):
+    uploaded = []
+
+    for blob in await _upload_images_async(client, session, image_urls, post_id):
         if blob is None:
-            print("❌ Image too large even after compression — skipping.")
+            print(f"❌ Image could not be uploaded ({post_id}) — skipping.")
             continue
 
         uploaded.append({"image": blob.blob, "alt": alt_text})
 
     if not uploaded:
-        print("❌ No images could be uploaded.")
+        print(f"❌ No images could be uploaded ({post_id}).")
         return None
 
-    embed = {"$type": "app.bsky.embed.images", "images": uploaded}
+    return {"$type": "app.bsky.embed.images", "images": uploaded}
 
-    return client.app.bsky.feed.post.create(
-        repo=client.me.did,
-        record={
-            "$type": "app.bsky.feed.post",
-            "text": post_text,
-            "embed": embed,
-            "createdAt": client.get_current_time_iso(),
-        },
-    )
 
-
-def post_to_bluesky_gif(client, post_text, gif_url, alt_text):
-    print("Downloading GIF…")
-    gif_data = requests.get(gif_url).content
+async def prepare_gif_embed(client, session, gif_url, alt_text, post_id):
+    print(f"Downloading GIF… ({post_id})")
+    gif_data = await download_bytes(session, gif_url, MAX_VIDEO_BYTES)
+    if gif_data is None:
+        print(f"❌ GIF too large to convert ({post_id}) — skipping.")
+        return None
 
     if len(gif_data) > 900_000:
-        print("GIF too large → converting to MP4…")
-        mp4_data = convert_gif_to_mp4(gif_data)
+        print(f"GIF too large → converting to MP4… ({post_id})")
+        mp4_data = await asyncio.to_thread(convert_gif_to_mp4, gif_data)
         if mp4_data is None:
-            print("❌ Could not convert GIF — skipping.")
+            print(f"❌ Could not convert GIF ({post_id}) — skipping.")
             return None
 
-        blob = upload_with_compression(client, mp4_data)
+        blob = await upload_with_compression_async(client, mp4_data)
         if blob is None:
-            print("❌ MP4 upload failed.")
+            print(f"❌ MP4 upload failed ({post_id}).")
             return None
 
-        video_embed = {
+        return {
             "$type": "app.bsky.embed.video",
             "video": blob.blob,
             "alt": alt_text
         }
 
-        return client.app.bsky.feed.post.create(
-            repo=client.me.did,
-            record={
-                "$type": "app.bsky.feed.post",
-                "text": post_text,
-                "embed": video_embed,
-                "createdAt": client.get_current_time_iso(),
-            }
-        )
-
-    blob = upload_with_compression(client, gif_data)
+    blob = await upload_with_compression_async(client, gif_data)
     if blob is None:
-        print("❌ GIF upload failed.")
+        print(f"❌ GIF upload failed ({post_id}).")
         return None
 
-    embed = {
+    return {
         "$type": "app.bsky.embed.images",
         "images": [{"image": blob.blob, "alt": alt_text}],
     }
 
-    return client.app.bsky.feed.post.create(
-        repo=client.me.did,
-        record={
-            "$type": "app.bsky.feed.post",
-            "text": post_text,
-            "embed": embed,
-            "createdAt": client.get_current_time_iso(),
-        },
-    )
-
 
 # ---------------------------------------------------------
 #        FETCH RECENT BLUESKY POSTS TO PREVENT DUPES
 # ---------------------------------------------------------
 
-def get_recent_bsky_tumblr_ids(client):
-    feed = client.app.bsky.feed.get_author_feed(
-        params={"actor": client.me.did, "limit": 50}
-    )
+BSKY_FEED_PAGE = 50          # author-feed items per request
+BSKY_FEED_MAX_PAGES = 4      # look back at most 200 posts
+
+
+def _created_ts(record):
+    # Epoch seconds of a record's createdAt, or None if missing/unparseable
+    try:
+        return datetime.fromisoformat(
+            record.created_at.replace("Z", "+00:00")
+        ).timestamp()
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def get_recent_bsky_tumblr_ids(client, did, needed=None, since=None):
+    """
+    Collect Tumblr IDs mentioned in our recent Bluesky posts, paging back
+    through the author feed. Stops as soon as all of `needed` were seen,
+    or once our own posts are older than `since` (epoch seconds), since
+    a crosspost can't predate its Tumblr post.
+    """
+    get_author_feed = client.app.bsky.feed.get_author_feed
 
     tumblr_ids = set()
-    TUMBLR_ID_REGEX = re.compile(r"(?:tumblr\.com/.*/post/|tumblr\.com/post/|/post/)(\d+)")
+    cursor = None
 
-    for item in feed.feed:
-        post = getattr(item, "post", None)
-        if not post:
-            continue
+    for _ in range(BSKY_FEED_MAX_PAGES):
+        params = {"actor": did, "limit": BSKY_FEED_PAGE}
+        if cursor:
+            params["cursor"] = cursor
+        feed = get_author_feed(params=params)
 
-        record = getattr(post, "record", None)
-        if not record:
-            continue
+        for item in feed.feed:
+            post = getattr(item, "post", None)
+            if not post:
+                continue
 
-        text = getattr(record, "text", "")
-        if not isinstance(text, str):
-            continue
+            record = getattr(post, "record", None)
+            if not record:
+                continue
+
+            # Reposts carry someone else's (older) timestamp
+            if since is not None and getattr(item, "reason", None) is None:
+                ts = _created_ts(record)
+                if ts is not None and ts < since:
+                    return tumblr_ids
+
+            text = getattr(record, "text", "")
+            if not isinstance(text, str):
+                continue
 
-        for match in TUMBLR_ID_REGEX.findall(text):
-            tumblr_ids.add(match)
+            linked, bare = [], []
+            for url_id, raw_id in TUMBLR_ID_RE.findall(text):
+                if url_id:
+                    linked.append(url_id)
+                else:
+                    bare.append(raw_id)
+            tumblr_ids.update(linked or bare)
 
-        for match in re.findall(r"\b(\d{9,20})\b", text):
-            tumblr_ids.add(match)
+            if needed and needed <= tumblr_ids:
+                return tumblr_ids
+
+        cursor = getattr(feed, "cursor", None)
+        if not cursor:
+            break
 
     return tumblr_ids
 
@@ -455,18 +915,41 @@ def get_recent_bsky_tumblr_ids(client):
 #                MAIN LOGIC
 # ---------------------------------------------------------
 
-def main():
+async def main():
     print("Running Tumblr → Bluesky crossposter…")
 
-    client = get_bsky_client()
+    async with make_http_session() as session:
+        await crosspost(session)
 
-    bsky_ids = get_recent_bsky_tumblr_ids(client)
-    print("Found", len(bsky_ids), "existing Tumblr IDs on Bluesky.")
+    print("\nDone!")
 
+
+async def crosspost(session):
     state = load_state()
     posted_ids = state["posted_ids"]
+    posted_set = set(posted_ids)   # O(1) membership; the deque keeps order
+
+    bloom = load_bloom(posted_ids)
+
+    def is_posted(pid):
+        # Bloom "no" is definite; a "yes" outside the last 500 IDs is
+        # trusted too (false-positive rate ~1e-4).
+        return pid in posted_set or bloom_contains(bloom, pid)
+
+    def mark_posted(pid):
+        posted_ids.append(pid)
+        posted_set.add(pid)
+        bloom_add(bloom, pid)
+
+    def checkpoint():
+        save_state(state)
+        save_bloom(bloom)
+
+    posts, etag = await get_recent_tumblr_posts(session, state.get("etag"))
+    if posts is None:
+        print("Tumblr feed unchanged since last run — nothing to do.")
+        return
 
-    posts = get_recent_tumblr_posts()
     if not posts:
         print("❌ No Tumblr posts found.")
         return
@@ -474,64 +957,104 @@ def main():
     posts = sorted(posts, key=lambda p: p.get("timestamp", 0))
     posts = posts[:30]
 
-    for post in posts:
-        post_id = str(post.get("id"))
-        tumblr_link = post.get("post_url", "").strip()
-        post_text = make_post_text(tumblr_link, post)
-        alt_text = make_alt_text(post)
+    # Local state is free to check; only log in and pull the author feed
+    # when at least one post might still need crossposting.
+    new_posts = [p for p in posts if not is_posted(str(p.get("id")))]
+    if not new_posts:
+        print("No new Tumblr posts — nothing to do.")
+        state["etag"] = etag
+        save_state(state)
+        return
 
-        print("\n--- Checking Tumblr post:", post_id)
+    client = get_bsky_client()
 
-        if post_id in posted_ids or post_id in bsky_ids:
-            print("Already posted — skipping.")
-            continue
+    did = client.me.did
 
-        video = extract_video(post)
-        gif = extract_gif(post)
-        images = extract_images(post)
+    needed = {str(p.get("id")) for p in new_posts}
+    since = min(p.get("timestamp", 0) for p in new_posts)
+    bsky_ids = get_recent_bsky_tumblr_ids(client, did, needed, since)
+    print("Found", len(bsky_ids), "existing Tumblr IDs on Bluesky.")
 
-        if video:
-            print("Posting VIDEO…")
-            try:
-                post_to_bluesky_video(client, post_text, video, alt_text)
-                print("✔ Video posted.")
-                posted_ids.append(post_id)
-                save_state(state)
-            except Exception as e:
-                print("❌ Video error:", e)
-            continue
+    sem = asyncio.Semaphore(POST_CONCURRENCY)
+    completed = 0
 
-        if gif:
-            print("Processing GIF…")
-            try:
-                result = post_to_bluesky_gif(client, post_text, gif, alt_text)
-                if result:
-                    print("✔ GIF posted.")
-                posted_ids.append(post_id)
-                save_state(state)
-            except Exception as e:
-                print("❌ GIF error:", e)
-            continue
+    async def process_post(post, prev_done, done):
+        nonlocal completed
+        try:
+            post_id = str(post.get("id"))
+            print("\n--- Checking Tumblr post:", post_id)
+
+            if is_posted(post_id) or post_id in bsky_ids:
+                print(f"Already posted ({post_id}) — skipping.")
+                return
+
+            tumblr_link = post.get("post_url", "").strip()
+            post_text = make_post_text(tumblr_link, post)
+            alt_text = make_alt_text(post)
+
+            video, gif, images = extract_media(post)
+
+            if video:
+                print(f"Posting VIDEO… ({post_id})")
+                label, prepare = "Video", prepare_video_embed(client, session, video, alt_text, post_id)
+            elif gif:
+                print(f"Processing GIF… ({post_id})")
+                label, prepare = "GIF", prepare_gif_embed(client, session, gif, alt_text, post_id)
+            elif images:
+                print(f"Posting {len(images)} IMAGES… ({post_id})")
+                label, prepare = "Images", prepare_images_embed(client, session, images, alt_text, post_id)
+            else:
+                print(f"Nothing postable ({post_id}) — skipping.")
+                mark_posted(post_id)
+                return
 
-        if images:
-            print(f"Posting {len(images)} IMAGES…")
             try:
-                res = post_to_bluesky_images(client, post_text, images, alt_text)
-                if res:
-                    print("✔ Images posted.")
-                    posted_ids.append(post_id)
-                    save_state(state)
+                async with sem:
+                    embed = await prepare
+
+                # Media is prepared in parallel, but records are created in
+                # Tumblr order so the Bluesky timeline matches.
+                await prev_done.wait()
+                if embed is not None:
+                    created_at = client.get_current_time_iso()
+                    await create_post_async(client, did, post_text, embed, created_at)
+                    print(f"✔ {label} posted ({post_id}).")
+
+                # A GIF that could not be converted/uploaded, or a video
+                # over the size limit, is not retried
+                if embed is not None or label in ("GIF", "Video"):
+                    mark_posted(post_id)
             except Exception as e:
-                print("❌ Image error:", e)
-            continue
-
-        print("Nothing postable — skipping.")
-        posted_ids.append(post_id)
-        save_state(state)
+                print(f"❌ {label} error ({post_id}):", e)
+        finally:
+            # Never let a later post overtake an earlier one, even when this
+            # one was skipped or failed early.
+            await prev_done.wait()
+            done.set()
+            completed += 1
+            if completed % SAVE_EVERY == 0:
+                checkpoint()
 
-    print("\nDone!")
+    try:
+        first = asyncio.Event()
+        first.set()
+        events = [first] + [asyncio.Event() for _ in posts]
+        results = await asyncio.gather(
+            *(process_post(p, events[i], events[i + 1]) for i, p in enumerate(posts)),
+            return_exceptions=True,
+        )
+        for r in results:
+            if isinstance(r, BaseException):
+                raise r
+
+        # Only trust the ETag once every new post went through, otherwise a
+        # 304 next run would hide the ones that failed.
+        if all(is_posted(str(p.get("id"))) or str(p.get("id")) in bsky_ids for p in new_posts):
+            state["etag"] = etag
+    finally:
+        checkpoint()
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
 